@@ -19,13 +19,14 @@ from tools.config import EM_CONFIG
 from tools.shared import EMCC
 from tools.shared import CANONICAL_TEMP_DIR
 from tools.shared import try_delete, config
-from tools.shared import EXPECTED_LLVM_VERSION, Cache
+from tools.shared import EXPECTED_LLVM_VERSION, Cache, PYTHON
 from tools import shared, utils
 from tools import response_file
 from tools import ports
 
 SANITY_FILE = shared.Cache.get_path('sanity.txt')
 commands = [[EMCC], [path_from_root('tests/runner'), 'blahblah']]
+EMCONFIG = shared.bat_suffix(path_from_root('em-config'))
 
 
 def restore():
@@ -694,6 +695,80 @@ fi
     open(EM_CONFIG, 'a').write('\ndel BINARYEN_ROOT\n')
     self.check_working([EMCC, test_file('hello_world.c')], 'BINARYEN_ROOT is not defined in %s' % EM_CONFIG)
 
+  def test_literal_config(self):
+    # Config files consisting only of literal assignments are parsed without
+    # being executed and the result is cached.  Make sure that edits to the
+    # config file are still noticed.
+    restore_and_set_up()
+    open(EM_CONFIG, 'w').write(get_basic_config())
+    self.check_working(EMCC)
+
+    open(EM_CONFIG, 'a').write('\nBINARYEN_ROOT = ""\n')
+    self.check_working(EMCC, 'BINARYEN_ROOT is set to empty value in %s' % EM_CONFIG)
+
+  def test_config_from_env(self):
+    # When every config setting is provided via EM_<KEY> environment variables
+    # the config file itself is not read.
+    restore_and_set_up()
+    env = {'EM_' + key: '' for key in config.CONFIG_KEYS}
+    env['EM_LLVM_ROOT'] = config.LLVM_ROOT
+    env['EM_BINARYEN_ROOT'] = config.BINARYEN_ROOT
+    env['EM_NODE_JS'] = config.NODE_JS[0]
+    env['EM_CACHE'] = config.CACHE
+    open(EM_CONFIG, 'w').write('blah\n')
+    with env_modify(env):
+      self.check_working(EMCC)
+
+  def test_config_lazy(self):
+    def run_python(code):
+      return self.run_process([PYTHON, '-c', code], stdout=PIPE, cwd=path_from_root()).stdout.strip()
+
+    # The config file is only parsed (and only needs to exist) once one of the
+    # settings is accessed.
+    self.assertNotExists(EM_CONFIG)
+    out = run_python('from tools import config; print(config.EMSCRIPTEN_ROOT)')
+    self.assertEqual(out, path_from_root())
+
+    # Settings assigned before the config is parsed are not overwritten by it.
+    restore_and_set_up()
+    out = run_python('from tools import config; config.CACHE = "my_cache"; config.NODE_JS; print(config.CACHE)')
+    self.assertEqual(out, 'my_cache')
+
+  def test_spidermonkey_engine(self):
+    def get_engine():
+      return self.run_process([EMCONFIG, 'SPIDERMONKEY_ENGINE'], stdout=PIPE).stdout.strip()
+
+    # SPIDERMONKEY_ENGINE always gets -w, even when specified as a string.
+    restore_and_set_up()
+    add_to_config('SPIDERMONKEY_ENGINE = "js"')
+    self.assertEqual(get_engine(), "['js', '-w']")
+
+    # An argument that merely starts with -w doesn't count.
+    restore_and_set_up()
+    add_to_config('SPIDERMONKEY_ENGINE = ["js", "-wat"]')
+    self.assertEqual(get_engine(), "['js', '-wat', '-w']")
+
+  @with_env_modify({'EM_CONFIG': None})
+  def test_config_dir_skipped(self):
+    # A directory called .emscripten is not a config file, and is skipped when
+    # searching for one.
+    default_config = config.embedded_config
+    ensure_dir(default_config)
+    ensure_dir('.emscripten')
+    try:
+      with env_modify({'HOME': self.get_dir()}):
+        output = self.do([EMCC, '-v'])
+    finally:
+      os.rmdir(default_config)
+    self.assertContained('emcc: error: config file not found: %s' % default_config, output)
+    self.assertNotContained('Traceback', output)
+
+    # The same goes for an EM_CONFIG that points to a directory.
+    with env_modify({'EM_CONFIG': self.get_dir()}):
+      output = self.do([EMCC, '-v'])
+    self.assertContained('emcc: error: config file not found: %s' % self.get_dir(), output)
+    self.assertNotContained('Traceback', output)
+
   def test_embuilder_force(self):
     restore_and_set_up()
     self.do([EMBUILDER, 'build', 'libemmalloc'])
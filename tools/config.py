@@ -3,7 +3,12 @@
 # University of Illinois/NCSA Open Source License.  Both these licenses can be
 # found in the LICENSE file.
 
+import ast
+import hashlib
+import marshal
 import os
+import re
+import stat
 import sys
 import logging
 
@@ -12,29 +17,48 @@ from .utils import path_from_root, exit_with_error, __rootpath__, which
 
 logger = logging.getLogger('config')
 
-# The following class can be overridden by the config file and/or
-# environment variables.  Specifically any variable whose name
-# is in ALL_UPPER_CASE is condifered a valid config file key.
-# See parse_config_file below.
 EMSCRIPTEN_ROOT = __rootpath__
-NODE_JS = None
-BINARYEN_ROOT = None
-SPIDERMONKEY_ENGINE = None
-V8_ENGINE = None
-LLVM_ROOT = None
-LLVM_ADD_VERSION = None
-CLANG_ADD_VERSION = None
-CLOSURE_COMPILER = None
-JAVA = None
-JS_ENGINE = None
-JS_ENGINES = None
-WASMER = None
-WASMTIME = None
-WASM_ENGINES = []
-FROZEN_CACHE = None
-CACHE = None
-PORTS = None
-COMPILER_WRAPPER = None
+
+# The following settings can be overridden by the config file and/or
+# environment variables.  Only these settings are propagated from the config
+# file.  See parse_config_file below.
+#
+# The settings (along with EM_CONFIG) are not defined until the config file is
+# first needed.  Accessing any of them triggers the parsing of the config file
+# (see __getattr__ at the bottom of this file) so that tools that only need,
+# e.g., EMSCRIPTEN_ROOT don't pay for it.
+CONFIG_KEYS = (
+  'NODE_JS',
+  'BINARYEN_ROOT',
+  'SPIDERMONKEY_ENGINE',
+  'V8_ENGINE',
+  'LLVM_ROOT',
+  'LLVM_ADD_VERSION',
+  'CLANG_ADD_VERSION',
+  'CLOSURE_COMPILER',
+  'JAVA',
+  'JS_ENGINE',
+  'JS_ENGINES',
+  'WASMER',
+  'WASMTIME',
+  'WASM_ENGINES',
+  'FROZEN_CACHE',
+  'CACHE',
+  'PORTS',
+  'COMPILER_WRAPPER',
+)
+
+_CONFIG_KEY_SET = frozenset(CONFIG_KEYS)
+
+# Sentinel used to distinguish unset keys from keys explicitly set to None.
+_MISSING = object()
+
+# This module's namespace, which the config settings are written into.
+_G = sys.modules[__name__].__dict__
+
+_parsed = False
+# The result of stat'ing EM_CONFIG, recorded when checking that it exists.
+_em_config_stat = None
 
 
 def listify(x):
@@ -43,11 +67,22 @@ def listify(x):
   return [x]
 
 
+def listify_engines(engines):
+  """Listify each of the given engines, updating the list in place."""
+  for i, engine in enumerate(engines):
+    if engine is not None and type(engine) is not list:
+      engines[i] = [engine]
+
+
 def fix_js_engine(old, new):
   if old is None:
     return
-  global JS_ENGINES
-  JS_ENGINES = [new if x == old else x for x in JS_ENGINES]
+  if old is new or old == new:
+    # Nothing to replace (e.g. the engine was already a list).
+    return new
+  for i, engine in enumerate(JS_ENGINES):
+    if engine == old:
+      JS_ENGINES[i] = new
   return new
 
 
@@ -57,25 +92,31 @@ def root_is_writable():
 
 def normalize_config_settings():
   global CACHE, PORTS, LLVM_ADD_VERSION, CLANG_ADD_VERSION, CLOSURE_COMPILER
-  global NODE_JS, V8_ENGINE, JS_ENGINE, JS_ENGINES, SPIDERMONKEY_ENGINE, WASM_ENGINES
+  global NODE_JS, V8_ENGINE, JS_ENGINE, JS_ENGINES, SPIDERMONKEY_ENGINE, WASM_ENGINES, FROZEN_CACHE
 
   # EM_CONFIG stuff
   if not JS_ENGINES:
     JS_ENGINES = [NODE_JS]
+  elif type(JS_ENGINES) is not list:
+    JS_ENGINES = list(JS_ENGINES)
+  if not WASM_ENGINES:
+    WASM_ENGINES = []
+  elif type(WASM_ENGINES) is not list:
+    WASM_ENGINES = list(WASM_ENGINES)
   if not JS_ENGINE:
     JS_ENGINE = JS_ENGINES[0]
 
   # Engine tweaks
   if SPIDERMONKEY_ENGINE:
-    new_spidermonkey = SPIDERMONKEY_ENGINE
-    if '-w' not in str(new_spidermonkey):
-      new_spidermonkey += ['-w']
+    new_spidermonkey = listify(SPIDERMONKEY_ENGINE)
+    if '-w' not in new_spidermonkey:
+      new_spidermonkey.append('-w')
     SPIDERMONKEY_ENGINE = fix_js_engine(SPIDERMONKEY_ENGINE, new_spidermonkey)
   NODE_JS = fix_js_engine(NODE_JS, listify(NODE_JS))
   V8_ENGINE = fix_js_engine(V8_ENGINE, listify(V8_ENGINE))
   JS_ENGINE = fix_js_engine(JS_ENGINE, listify(JS_ENGINE))
-  JS_ENGINES = [listify(engine) for engine in JS_ENGINES]
-  WASM_ENGINES = [listify(engine) for engine in WASM_ENGINES]
+  listify_engines(JS_ENGINES)
+  listify_engines(WASM_ENGINES)
   CLOSURE_COMPILER = listify(CLOSURE_COMPILER)
   if not CACHE:
     if FROZEN_CACHE or root_is_writable():
@@ -99,68 +140,202 @@ def normalize_config_settings():
     CLANG_ADD_VERSION = os.getenv('CLANG_ADD_VERSION')
 
 
-def parse_config_file():
-  """Parse the emscripten config file using python's exec.
+def parse_config_literals(config_text):
+  """Extract config keys from a config file without executing it.
 
-  Also check EM_<KEY> environment variables to override specific config keys.
+  This only works for config files that consist solely of assignments of
+  literal values (such as the one produced by --generate-config).  Returns None
+  if the file contains anything else, in which case it needs to be exec'd.
   """
+  try:
+    tree = ast.parse(config_text)
+  except SyntaxError:
+    return None
+  config = {}
+  for node in tree.body:
+    if not isinstance(node, ast.Assign) or len(node.targets) != 1 or not isinstance(node.targets[0], ast.Name):
+      return None
+    try:
+      value = ast.literal_eval(node.value)
+    except (ValueError, TypeError):
+      return None
+    if node.targets[0].id in _CONFIG_KEY_SET:
+      config[node.targets[0].id] = value
+  return config
+
+
+def exec_config(path, config_text):
+  """Run the config file as python code and return the config keys it defines."""
   config = {}
-  config_text = utils.read_file(EM_CONFIG)
   try:
-    exec(config_text, config)
+    exec(compile(config_text, path, 'exec'), config)
   except Exception as e:
-    exit_with_error('Error in evaluating config file (%s): %s, text: %s', EM_CONFIG, str(e), config_text)
-
-  CONFIG_KEYS = (
-    'NODE_JS',
-    'BINARYEN_ROOT',
-    'SPIDERMONKEY_ENGINE',
-    'V8_ENGINE',
-    'LLVM_ROOT',
-    'LLVM_ADD_VERSION',
-    'CLANG_ADD_VERSION',
-    'CLOSURE_COMPILER',
-    'JAVA',
-    'JS_ENGINE',
-    'JS_ENGINES',
-    'WASMER',
-    'WASMTIME',
-    'WASM_ENGINES',
-    'FROZEN_CACHE',
-    'CACHE',
-    'PORTS',
-    'COMPILER_WRAPPER',
-  )
+    exit_with_error('Error in evaluating config file (%s): %s, text: %s', path, str(e), config_text)
+  # Don't hold on to anything else the config file defines (modules, helper
+  # functions, etc).
+  return {k: v for k, v in config.items() if k in _CONFIG_KEY_SET}
+
+
+# Identifies the layout of the config cache files.  Bump this whenever the
+# format of the cached data changes.
+_CONFIG_CACHE_MAGIC = b'EMC1'
+
+
+def config_cache_file(name, key):
+  # Note that this always lives in ~/.emscripten_cache (creating it if needed),
+  # regardless of the CACHE setting, since CACHE is itself read from the config.
+  # Each key gets its own file (named after a short hash of the key, much like
+  # __pycache__) so that different configs and environments don't keep evicting
+  # each other.  The full key is still checked when reading the file.
+  # The marshal format is only stable within a given python version.
+  key_hash = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()[:16]
+  filename = '%s.%s.py%d%d.marshal' % ((name, key_hash) + sys.version_info[:2])
+  return os.path.join(os.path.expanduser(os.path.join('~', '.emscripten_cache')), filename)
+
+
+def read_config_cache(name, key):
+  """Return the data stored in the named config cache file if it matches `key`,
+  or _MISSING otherwise."""
+  try:
+    with open(config_cache_file(name, key), 'rb') as f:
+      if f.read(len(_CONFIG_CACHE_MAGIC)) != _CONFIG_CACHE_MAGIC:
+        return _MISSING
+      cached_key, data = marshal.load(f)
+  except Exception:
+    # Missing or unreadable cache file.
+    return _MISSING
+  if cached_key != key:
+    return _MISSING
+  return data
+
+
+def write_config_cache(name, key, data):
+  cache_file = config_cache_file(name, key)
+  temp_file = f'{cache_file}.{os.getpid()}.tmp'
+  try:
+    utils.safe_ensure_dirs(os.path.dirname(cache_file))
+    with open(temp_file, 'wb') as f:
+      f.write(_CONFIG_CACHE_MAGIC)
+      marshal.dump((key, data), f)
+    # On windows this fails if another process has the cache file open.
+    os.replace(temp_file, cache_file)
+  except (OSError, ValueError) as e:
+    logger.debug('unable to write config cache file %s: %s', cache_file, e)
+    # Don't leave partially written or orphaned temp files behind.
+    try:
+      os.unlink(temp_file)
+    except OSError:
+      pass
+
+
+def config_file_key(path, st):
+  """Return a key that identifies the config file and its current contents.
+
+  Where possible the file is identified by its device and inode rather than
+  its path, so that different spellings of the same file (e.g. via a symlink,
+  or `C:\\x` vs `C:/x`) share cache entries without needing to canonicalize
+  the path.
+  """
+  if st.st_ino:
+    ident = (st.st_dev, st.st_ino)
+  else:
+    ident = os.path.normcase(os.path.abspath(path))
+  return (ident, st.st_mtime_ns, st.st_size)
+
+
+def load_config_cached(path, st):
+  """Load the config file at `path` and return a dict of the keys it defines.
+
+  When the config file can be parsed without being executed (see
+  parse_config_literals) the result is memoized on disk, keyed on the
+  identity, mtime and size of the config file (see config_file_key).  This
+  avoids re-parsing the config in each of the many subprocesses that emcc
+  spawns.  Otherwise the fact that the file needs to be exec'd is memoized, so
+  that later loads don't attempt to parse it again.
+
+  Also returns whether the result is safe to memoize.
+  """
+  key = config_file_key(path, st)
+  # A None entry in the cache marks a config file that needs to be exec'd.
+  config = read_config_cache('config_parse', key)
+  if config is not _MISSING and config is not None:
+    return config, True
+
+  config_text = utils.read_file(path)
+  if config is _MISSING:
+    config = parse_config_literals(config_text)
+    write_config_cache('config_parse', key, config)
+    if config is not None:
+      return config, True
+
+  # The result of executing the config file can depend on things other than
+  # its contents (e.g. environment variables) so it is never memoized.
+  return exec_config(path, config_text), False
+
+
+def parse_config_file():
+  """Parse the emscripten config file.
+
+  Also check EM_<KEY> environment variables to override specific config keys.
+  """
+  st = _em_config_stat
+
+  # Collect all the EM_<KEY> environment variables in a single pass over the
+  # environment rather than querying it once per key.
+  em_env = {k[3:]: v for k, v in os.environ.items() if k.startswith('EM_')}
+
+  # The final settings depend only on the config file, the EM_<KEY> overrides
+  # and a few other details of the environment (including the emscripten root
+  # and home directory, which the default CACHE is derived from).  Once
+  # computed they are snapshotted so that subprocesses (which re-import this
+  # module with the same config) can skip straight to the result.
+  settings_key = (config_file_key(EM_CONFIG, st),
+                  tuple(em_env.get(key) for key in CONFIG_KEYS),
+                  os.environ.get('LLVM_ADD_VERSION'),
+                  os.environ.get('CLANG_ADD_VERSION'),
+                  __rootpath__,
+                  os.path.expanduser('~'),
+                  root_is_writable())
+  settings = read_config_cache('config_settings', settings_key)
+  if settings is not _MISSING:
+    _G.update(settings)
+    return
+
+  # When every setting is overridden via EM_<KEY> (as is common in CI
+  # setups) the contents of the config file are irrelevant, so don't read it.
+  env_only = _CONFIG_KEY_SET.issubset(em_env)
+  if env_only:
+    config, cacheable = {}, True
+  else:
+    config, cacheable = load_config_cached(EM_CONFIG, st)
 
   # Only propagate certain settings from the config file.
   for key in CONFIG_KEYS:
-    env_var = 'EM_' + key
-    env_value = os.environ.get(env_var)
-    if env_value is not None:
-      if env_value == '':
-        env_value = None
-      globals()[key] = env_value
-    elif key in config:
-      globals()[key] = config[key]
+    value = em_env.get(key, _MISSING)
+    if value is _MISSING:
+      value = config.get(key, _MISSING)
+    elif value == '':
+      value = None
+    if value is not _MISSING:
+      _G[key] = value
 
   # In the past the default-generated .emscripten config file would read certain environment
   # variables. We used generate a warning here but that could generates false positives
   # See https://github.com/emscripten-core/emsdk/issues/862
   LEGACY_ENV_VARS = {
-    'LLVM': 'EM_LLVM_ROOT',
-    'BINARYEN': 'EM_BINARYEN_ROOT',
-    'NODE': 'EM_NODE_JS',
+    'LLVM': 'LLVM_ROOT',
+    'BINARYEN': 'BINARYEN_ROOT',
+    'NODE': 'NODE_JS',
   }
   for key, new_key in LEGACY_ENV_VARS.items():
-    env_value = os.environ.get(key)
-    if env_value and new_key not in os.environ:
-      logger.debug(f'legacy environment variable found: `{key}`.  Please switch to using `{new_key}` instead`')
+    if os.environ.get(key) and new_key not in em_env:
+      logger.debug('legacy environment variable found: `%s`.  Please switch to using `EM_%s` instead', key, new_key)
 
   # Certain keys are mandatory
   for key in ('LLVM_ROOT', 'NODE_JS', 'BINARYEN_ROOT'):
-    if key not in config:
+    if key not in config and not env_only:
       exit_with_error('%s is not defined in %s', key, EM_CONFIG)
-    if not globals()[key]:
+    if not _G[key]:
       exit_with_error('%s is set to empty value in %s', key, EM_CONFIG)
 
   if not NODE_JS:
@@ -168,24 +343,31 @@ def parse_config_file():
 
   normalize_config_settings()
 
+  if cacheable:
+    write_config_cache('config_settings', settings_key, {key: _G[key] for key in CONFIG_KEYS})
+
+
+def config_template():
+  template = utils.read_file(path_from_root('tools/config_template.py'))
+  return '\n'.join(template.splitlines()[3:]) # remove the initial comment
+
 
 def generate_config(path):
   if os.path.exists(path):
     exit_with_error(f'config file already exists: `{path}`')
 
-  # Note: repr is used to ensure the paths are escaped correctly on Windows.
-  # The full string is replaced so that the template stays valid Python.
-
-  config_data = utils.read_file(path_from_root('tools/config_template.py'))
-  config_data = config_data.splitlines()[3:] # remove the initial comment
-  config_data = '\n'.join(config_data)
   # autodetect some default paths
-  config_data = config_data.replace('\'{{{ EMSCRIPTEN_ROOT }}}\'', repr(__rootpath__))
   llvm_root = os.path.dirname(which('llvm-dis') or '/usr/bin/llvm-dis')
-  config_data = config_data.replace('\'{{{ LLVM_ROOT }}}\'', repr(llvm_root))
-
   node = which('node') or which('nodejs') or 'node'
-  config_data = config_data.replace('\'{{{ NODE }}}\'', repr(node))
+
+  # Note: repr is used to ensure the paths are escaped correctly on Windows.
+  # The full string is replaced so that the template stays valid Python.
+  replacements = {
+    'EMSCRIPTEN_ROOT': __rootpath__,
+    'LLVM_ROOT': llvm_root,
+    'NODE': node,
+  }
+  config_data = re.sub(r"'\{\{\{ (\w+) \}\}\}'", lambda m: repr(replacements[m.group(1)]), config_template())
 
   # write
   utils.write_file(path, config_data)
@@ -219,64 +401,139 @@ Please edit the file if any of those are incorrect.\
 # 5. User home directory config (~/.emscripten), if found.
 
 embedded_config = path_from_root('.emscripten')
-# For compatibility with `emsdk --embedded` mode also look two levels up.  The
-# layout of the emsdk puts emcc two levels below emsdk.  For example:
-#  - emsdk/upstream/emscripten/emcc
-#  - emsdk/emscipten/1.38.31/emcc
-# However `emsdk --embedded` stores the config file in the emsdk root.
-# Without this check, when emcc is run from within the emsdk in embedded mode
-# and the user forgets to first run `emsdk_env.sh` (which sets EM_CONFIG) emcc
-# will not see any config file at all and fall back to creating a new/emtpy
-# one.
-# We could remove this special case if emsdk were to write its embedded config
-# file into the emscripten directory itself.
-# See: https://github.com/emscripten-core/emsdk/pull/367
-emsdk_root = os.path.dirname(os.path.dirname(path_from_root()))
-emsdk_embedded_config = os.path.join(emsdk_root, '.emscripten')
-user_home_config = os.path.expanduser('~/.emscripten')
-
-if '--em-config' in sys.argv:
-  i = sys.argv.index('--em-config')
-  if len(sys.argv) <= i + 1:
+
+
+def extract_config_args(argv):
+  """Scan `argv` for --em-config and --generate-config in a single pass.
+
+  --em-config and its argument are removed from `argv`.  Returns the
+  --em-config argument (or None) and whether --generate-config was given.
+  """
+  em_config_index = None
+  generate = False
+  for i, arg in enumerate(argv):
+    if arg == '--em-config':
+      if em_config_index is None:
+        em_config_index = i
+    elif arg == '--generate-config':
+      if em_config_index is None or i != em_config_index + 1:
+        generate = True
+  if em_config_index is None:
+    return None, generate
+  if len(argv) <= em_config_index + 1:
     exit_with_error('--em-config must be followed by a filename')
-  EM_CONFIG = sys.argv.pop(i + 1)
-  del sys.argv[i]
-elif 'EM_CONFIG' in os.environ:
-  EM_CONFIG = os.environ['EM_CONFIG']
-elif os.path.exists(embedded_config):
-  EM_CONFIG = embedded_config
-elif os.path.exists(emsdk_embedded_config):
-  EM_CONFIG = emsdk_embedded_config
-elif os.path.exists(user_home_config):
-  EM_CONFIG = user_home_config
-else:
-  # No config file found.  Set EM_CONFIG to a default value
-  # that will get reported in the error below.
+  em_config = argv[em_config_index + 1]
+  del argv[em_config_index:em_config_index + 2]
+  return em_config, generate
+
+
+# The --em-config flag is removed from the command line at import time, even
+# though the config file itself is only parsed on demand, so that the tools
+# importing this module never see it.
+_em_config_arg, _generate_config = extract_config_args(sys.argv)
+
+
+def probe_config_file(path):
+  """Check that `path` exists and isn't a directory, recording its stat result."""
+  global _em_config_stat
+  try:
+    st = os.stat(path)
+  except (OSError, ValueError):
+    return False
+  if stat.S_ISDIR(st.st_mode):
+    return False
+  _em_config_stat = st
+  return True
+
+
+def find_config_file():
+  """Return the path of the config file, following the search order above.
+
+  Each candidate location is only computed when the previous ones have been
+  ruled out.
+  """
+  em_config = _em_config_arg
+  if em_config is None:
+    em_config = os.environ.get('EM_CONFIG')
+  if em_config is not None:
+    # We used to support inline EM_CONFIG.
+    if '\n' in em_config:
+      exit_with_error('Inline EM_CONFIG data no longer supported.  Please use a config file.')
+    return os.path.expanduser(em_config)
+
+  if probe_config_file(embedded_config):
+    return embedded_config
+
+  # For compatibility with `emsdk --embedded` mode also look two levels up.  The
+  # layout of the emsdk puts emcc two levels below emsdk.  For example:
+  #  - emsdk/upstream/emscripten/emcc
+  #  - emsdk/emscipten/1.38.31/emcc
+  # However `emsdk --embedded` stores the config file in the emsdk root.
+  # Without this check, when emcc is run from within the emsdk in embedded mode
+  # and the user forgets to first run `emsdk_env.sh` (which sets EM_CONFIG) emcc
+  # will not see any config file at all and fall back to creating a new/emtpy
+  # one.
+  # We could remove this special case if emsdk were to write its embedded config
+  # file into the emscripten directory itself.
+  # See: https://github.com/emscripten-core/emsdk/pull/367
+  emsdk_root = os.path.dirname(os.path.dirname(__rootpath__))
+  emsdk_embedded_config = os.path.join(emsdk_root, '.emscripten')
+  if probe_config_file(emsdk_embedded_config):
+    return emsdk_embedded_config
+
+  user_home_config = os.path.expanduser('~/.emscripten')
+  if probe_config_file(user_home_config):
+    return user_home_config
+
+  # No config file found.  Return a default value that will get reported in
+  # the error below.
   if root_is_writable():
-    EM_CONFIG = embedded_config
+    return embedded_config
   else:
-    EM_CONFIG = user_home_config
+    return user_home_config
+
+
+def ensure_parsed():
+  """Locate and parse the config file, if that has not already been done."""
+  global _parsed, EM_CONFIG, WASM_ENGINES
+  if _parsed:
+    return
+  _parsed = True
+
+  # Settings assigned before the config was parsed (e.g. `config.CACHE = ...`)
+  # take precedence over the config file, just as they would have if the config
+  # had been parsed at import time.
+  assigned = {key: _G[key] for key in CONFIG_KEYS if key in _G}
+  for key in CONFIG_KEYS:
+    _G[key] = None
+  WASM_ENGINES = []
+
+  EM_CONFIG = find_config_file()
 
-# We used to support inline EM_CONFIG.
-if '\n' in EM_CONFIG:
-  exit_with_error('Inline EM_CONFIG data no longer supported.  Please use a config file.')
+  # This command line flag needs to work even in the absence of a config file, so we must process it
+  # here (otherwise the error below will trigger).
+  if _generate_config:
+    generate_config(EM_CONFIG)
+    sys.exit(0)
 
-EM_CONFIG = os.path.expanduser(EM_CONFIG)
+  if _em_config_stat is None and not probe_config_file(EM_CONFIG):
+    exit_with_error(f'config file not found: {EM_CONFIG}.  Please create one by hand or run `emcc --generate-config`')
 
-# This command line flag needs to work even in the absence of a config file, so we must process it
-# here at script import time (otherwise the error below will trigger).
-if '--generate-config' in sys.argv:
-  generate_config(EM_CONFIG)
-  sys.exit(0)
+  logger.debug('emscripten config is located in %s', EM_CONFIG)
 
-if not os.path.exists(EM_CONFIG):
-  exit_with_error(f'config file not found: {EM_CONFIG}.  Please create one by hand or run `emcc --generate-config`')
+  # Emscripten compiler spawns other processes, which can reimport shared.py, so
+  # make sure that those child processes get the same configuration file by
+  # setting it to the currently active environment.
+  os.environ['EM_CONFIG'] = EM_CONFIG
 
-logger.debug('emscripten config is located in ' + EM_CONFIG)
+  parse_config_file()
+  _G.update(assigned)
 
-# Emscripten compiler spawns other processes, which can reimport shared.py, so
-# make sure that those child processes get the same configuration file by
-# setting it to the currently active environment.
-os.environ['EM_CONFIG'] = EM_CONFIG
 
-parse_config_file()
+def __getattr__(name):
+  # Called only for names not (yet) defined in this module.  See CONFIG_KEYS.
+  if not _parsed and not name.startswith('__'):
+    ensure_parsed()
+    if name in _G:
+      return _G[name]
+  raise AttributeError(f'module {__name__!r} has no attribute {name!r}')